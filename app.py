@@ -1,25 +1,116 @@
-from flask import Flask, request, jsonify, redirect, url_for, render_template, session
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import (Flask, Response, g, request, jsonify, redirect, url_for, render_template, session,
+                   stream_with_context, before_render_template, template_rendered)
 import json
 import os
+import time
+
+import bulk
+from directory import UserDirectory
+from hashing import Overloaded, PasswordHasher
+import metrics
+from policy import PolicyEngine
+from profiling import SlowRequestProfiler
+from sessions import MemorySessionStore, ServerSessionInterface, SqliteSessionStore
+from storage import open_store
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
 
-# Data storage using JSON file
-data_file = 'user_data.json'
-if not os.path.exists(data_file):
-    with open(data_file, 'w') as f:
-        json.dump([], f)
-
-# Utility functions to read/write data
-def read_users():
-    with open(data_file, 'r') as f:
-        return json.load(f)
-
-def write_users(users):
-    with open(data_file, 'w') as f:
-        json.dump(users, f, indent=4)
+# Data storage, by default a JSON file indexed by username in memory. Set
+# USER_STORAGE=journal to append writes to a journal instead of rewriting the
+# whole file, or USER_STORAGE=sqlite to keep users in an SQLite database.
+# Both let several workers share the store.
+storage_backend = os.environ.get('USER_STORAGE', 'json')
+default_data_file = 'user_data.db' if storage_backend == 'sqlite' else 'user_data.json'
+data_file = os.environ.get('USER_DATA_FILE', default_data_file)
+store = open_store(storage_backend, data_file)
+
+# Sorted username index behind the admin user browser
+directory = UserDirectory(store)
+
+# Password hashing runs in a bounded process pool. PASSWORD_HASH_METHOD takes
+# any werkzeug method string, including its cost, e.g. "scrypt:65536:8:1" or
+# "pbkdf2:sha256:600000"; stored hashes are upgraded to it on login.
+hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD', 'scrypt'),
+    workers=int(os.environ['PASSWORD_HASH_WORKERS']) if 'PASSWORD_HASH_WORKERS' in os.environ else None,
+    max_pending=int(os.environ.get('PASSWORD_HASH_QUEUE', 0)) or None,
+)
+
+# Server-side sessions, so deprovisioning a user ends their sessions. The
+# default in-memory store is per process; use SESSION_STORE=sqlite to share
+# sessions between workers.
+session_ttl = int(os.environ.get('SESSION_TTL', 8 * 3600))
+if os.environ.get('SESSION_STORE', 'memory') == 'sqlite':
+    session_store = SqliteSessionStore(os.environ.get('SESSION_DB_FILE', 'sessions.db'), ttl=session_ttl)
+else:
+    session_store = MemorySessionStore(ttl=session_ttl)
+app.session_interface = ServerSessionInterface(session_store)
+
+# Role -> permission policy, reloaded automatically when policy.json changes
+policy = PolicyEngine(os.environ.get('POLICY_FILE', os.path.join(app.root_path, 'policy.json')))
+requires = policy.requires
+
+@app.context_processor
+def policy_helpers():
+    return {'can': policy.can}
+
+# Request, template, storage and KDF timings, exposed at /metrics per worker
+# (each sample is labelled with the worker's pid). Set PROFILE_SLOW_MS to also
+# dump cProfile output for slow requests.
+metrics.REGISTRY.register(metrics.Gauge('registered_users', 'Number of registered users.', callback=lambda: len(store)))
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if 'request_start' not in g:
+        return response
+    start = g.request_start
+    labels = {
+        'route': request.url_rule.rule if request.url_rule else 'unmatched',
+        'method': request.method,
+        'status': response.status_code,
+    }
+
+    def observe():
+        metrics.request_seconds.observe(time.perf_counter() - start, **labels)
+
+    # A streamed body is only produced after this hook, so time those
+    # responses when the server closes them.
+    if response.is_streamed:
+        response.call_on_close(observe)
+    else:
+        observe()
+    return response
+
+def start_template_timer(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+def record_template(sender, template, context, **extra):
+    if 'template_start' in g:
+        metrics.template_seconds.observe(time.perf_counter() - g.pop('template_start'), template=template.name)
+
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(record_template, app)
+
+if os.environ.get('PROFILE_SLOW_MS'):
+    SlowRequestProfiler(
+        app,
+        threshold=float(os.environ['PROFILE_SLOW_MS']) / 1000,
+        sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0)),
+        directory=os.environ.get('PROFILE_DIR', 'profiles'),
+    )
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    return 'Server busy, please try again later.', 503, {'Retry-After': '1'}
 
 @app.route('/')
 def home():
@@ -33,17 +124,12 @@ def register():
         role = request.form['role']
 
         # Hash the password
-        hashed_password = generate_password_hash(password)
+        hashed_password = hasher.hash(password)
 
-        users = read_users()
-
-        # Check if user already exists
-        if any(user['username'] == username for user in users):
+        # Add the new user unless it already exists
+        if not store.add_user({'username': username, 'password': hashed_password, 'role': role}):
             return 'User already exists!'
-
-        # Append new user to the JSON data
-        users.append({'username': username, 'password': hashed_password, 'role': role})
-        write_users(users)
+        directory.add(username, role)
 
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -54,39 +140,96 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        users = read_users()
-
         # Find the user
-        user = next((user for user in users if user['username'] == username), None)
-        if user and check_password_hash(user['password'], password):
+        user = store.get_user(username)
+        if user and hasher.verify(user['password'], password):
+            # Upgrade hashes made with outdated parameters while we have the
+            # plaintext; this is best effort and skipped under load.
+            try:
+                if hasher.needs_rehash(user['password']):
+                    store.update_user(dict(user, password=hasher.hash(password)))
+                    directory.sync_generation()
+            except Overloaded:
+                pass
             session['username'] = username
             session['role'] = user['role']
+            metrics.logins.inc(result='success')
             return redirect(url_for('dashboard'))
         else:
+            metrics.logins.inc(result='failure')
             return 'Invalid credentials!'
 
     return render_template('login.html')
 
 @app.route('/dashboard')
+@requires('dashboard.view')
 def dashboard():
-    if 'username' not in session:
-        return redirect(url_for('login'))
-    return render_template('dashboard.html', username=session['username'], role=session['role'])
+    # Admins get a page of the user directory, filtered like /users
+    users_page = None
+    if policy.can('users.list'):
+        users_page = user_page_args()
+        users_page['users'], users_page['next_cursor'] = directory.page(**users_page)
+        users_page['roles'] = policy.policy.roles
+    return render_template('dashboard.html', username=session['username'], role=session['role'],
+                           users_page=users_page)
+
+def user_page_args():
+    return {
+        'prefix': request.args.get('prefix', ''),
+        'role': request.args.get('role') or None,
+        'cursor': request.args.get('cursor') or None,
+        'limit': min(max(request.args.get('limit', 50, type=int), 1), 500),
+    }
+
+@app.route('/users')
+@requires('users.list')
+def list_users():
+    users, next_cursor = directory.page(**user_page_args())
+    return jsonify({
+        'users': [{'username': username, 'role': role} for username, role in users],
+        'next_cursor': next_cursor,
+    })
 
 @app.route('/deprovision', methods=['POST'])
+@requires('users.deprovision')
 def deprovision():
-    if 'username' not in session or session['role'] != 'admin':
-        return 'Access Denied'
-
     username_to_delete = request.form['username']
-    users = read_users()
 
     # Delete the user if found
-    users = [user for user in users if user['username'] != username_to_delete]
-    write_users(users)
+    store.delete_user(username_to_delete)
+    session_store.revoke_user(username_to_delete)
+    directory.remove(username_to_delete)
 
     return redirect(url_for('dashboard'))
 
+# Bulk endpoints take a streamed CSV (text/csv, with a header row) or JSONL
+# body and stream back one JSON report line per row, then a summary line.
+def stream_report(records):
+    lines = (json.dumps(record) + '\n' for record in records)
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+@app.route('/provision/bulk', methods=['POST'])
+@requires('users.provision')
+def bulk_provision():
+    try:
+        fmt = bulk.upload_format(request)
+    except ValueError as e:
+        return str(e), 400
+
+    rows = bulk.iter_rows(request.stream, fmt)
+    return stream_report(bulk.provision(rows, store, hasher, directory, roles=policy.policy.roles))
+
+@app.route('/deprovision/bulk', methods=['POST'])
+@requires('users.deprovision')
+def bulk_deprovision():
+    try:
+        fmt = bulk.upload_format(request)
+    except ValueError as e:
+        return str(e), 400
+
+    rows = bulk.iter_rows(request.stream, fmt)
+    return stream_report(bulk.deprovision(rows, store, session_store, directory))
+
 @app.route('/logout')
 def logout():
     session.pop('username', None)
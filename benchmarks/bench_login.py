@@ -0,0 +1,69 @@
+# Measures POST /login latency for growing user stores. With the indexed
+# store the per-login cost should stay flat as the user count grows.
+#
+#   python benchmarks/bench_login.py [--sizes 1000 10000 100000] [--logins 200]
+#
+# The synthetic users come from generate_users.py and share one cheap hash,
+# so the benchmark measures the store lookup rather than the KDF. For full
+# register/login/dashboard/deprovision runs use run.py.
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import generate_users  # noqa: E402
+
+
+def bench(count, logins, workdir):
+    import app as app_module
+    from storage import JsonUserStore
+
+    path = os.path.join(workdir, f'users_{count}.json')
+    generate_users.generate(path, count)
+    app_module.store = JsonUserStore(path)
+    client = app_module.app.test_client()
+
+    # The last user is the worst case for a linear scan.
+    form = {'username': generate_users.username(count - 1), 'password': generate_users.PASSWORD}
+    client.post('/login', data=form)
+
+    timings = []
+    for _ in range(logins):
+        start = time.perf_counter()
+        resp = client.post('/login', data=form)
+        timings.append(time.perf_counter() - start)
+        assert resp.status_code == 302, resp.status_code
+    return {
+        'users': count,
+        'logins': logins,
+        'mean_ms': statistics.mean(timings) * 1000,
+        'p50_ms': statistics.median(timings) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--logins', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ['USER_DATA_FILE'] = os.path.join(workdir, 'default.json')
+        # Match the synthetic hashes so logins neither pay for nor upgrade
+        # to the default KDF.
+        os.environ['PASSWORD_HASH_METHOD'] = generate_users.HASH_METHOD
+        os.environ['PASSWORD_HASH_WORKERS'] = '0'
+        for count in args.sizes:
+            result = bench(count, args.logins, workdir)
+            print(f"{result['users']:>9} users  mean {result['mean_ms']:.3f} ms  "
+                  f"p50 {result['p50_ms']:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
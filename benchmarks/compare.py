@@ -0,0 +1,42 @@
+# Compares two result files written by run.py, scenario by scenario.
+#
+#   python benchmarks/compare.py benchmarks/results/before.json benchmarks/results/after.json
+import argparse
+import json
+
+METRICS = (('throughput_rps', 'req/s'), ('p50_ms', 'p50'), ('p95_ms', 'p95'), ('p99_ms', 'p99'))
+
+
+def load_runs(path):
+    with open(path) as f:
+        report = json.load(f)
+    runs = {(run['mode'], run['backend'], run['users']): run['scenarios'] for run in report['runs']}
+    return report['commit'], runs
+
+
+def change(old, new):
+    return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    base_commit, base_runs = load_runs(args.baseline)
+    cand_commit, cand_runs = load_runs(args.candidate)
+    print(f'{base_commit} -> {cand_commit}')
+    for key in sorted(base_runs.keys() & cand_runs.keys()):
+        mode, backend, users = key
+        for scenario, base in base_runs[key].items():
+            cand = cand_runs[key].get(scenario)
+            if cand is None:
+                continue
+            cells = [f"{label} {base.get(name, 0):.2f} -> {cand.get(name, 0):.2f} ({change(base.get(name, 0), cand.get(name, 0))})"
+                     for name, label in METRICS]
+            print(f'{mode:<6} {backend:<7} {users:>9} {scenario:<12} ' + '  '.join(cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Writes a synthetic user store for benchmarking.
+#
+#   python benchmarks/generate_users.py 100000 user_data.json [--backend json|journal|sqlite]
+#
+# Users are named user0000000, user0000001, ... with password "password";
+# every third user is a librarian and every tenth an admin, the rest are
+# students. All users share one cheap hash so generating a million of them
+# takes seconds; run the app with PASSWORD_HASH_METHOD=pbkdf2:sha256:1 to
+# keep it from upgrading them on login.
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'password'
+HASH_METHOD = 'pbkdf2:sha256:1'
+
+
+def username(i):
+    return f'user{i:07d}'
+
+
+def role(i):
+    if i % 10 == 0:
+        return 'admin'
+    return 'librarian' if i % 3 == 0 else 'student'
+
+
+def generate(path, count, backend='json'):
+    pwhash = generate_password_hash(PASSWORD, method=HASH_METHOD)
+    users = ({'username': username(i), 'password': pwhash, 'role': role(i)} for i in range(count))
+    if backend in ('json', 'journal'):
+        # The journal store's snapshot is the same JSON list.
+        with open(path, 'w') as f:
+            json.dump(list(users), f)
+        for suffix in ('.journal', '.lock'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    elif backend == 'sqlite':
+        from storage import SqliteUserStore
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+        SqliteUserStore(path)
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.executemany(
+                'INSERT INTO users (username, password, role) VALUES (:username, :password, :role)',
+                users,
+            )
+        conn.close()
+    else:
+        raise ValueError(f'unknown user storage backend: {backend!r}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('count', type=int)
+    parser.add_argument('path')
+    parser.add_argument('--backend', default='json', choices=['json', 'journal', 'sqlite'])
+    args = parser.parse_args()
+    generate(args.path, args.count, args.backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+# Load-test harness for the register, login, dashboard and deprovision hot
+# paths. For each store size it generates a synthetic user store (see
+# generate_users.py), then drives the routes either through the Flask test
+# client (--mode client, one request at a time) or over HTTP against a local
+# pre-forked WSGI server (--mode server, --workers processes and
+# --concurrency client threads). Throughput and p50/p95/p99 latency for each
+# scenario are printed and written as JSON, by default to
+# benchmarks/results/<time>-<commit>.json; compare two result files with
+# benchmarks/compare.py.
+#
+#   python benchmarks/run.py --users 1000 10000 100000 1000000
+#   python benchmarks/run.py --users 100000 --mode server --workers 4 --concurrency 16 --backend sqlite
+import argparse
+import http.client
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import generate_users  # noqa: E402
+
+SCENARIOS = ('register', 'login', 'dashboard', 'deprovision')
+ADMIN = generate_users.username(0)
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile of an already sorted list.
+    index = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def succeeded(scenario, status, location, body):
+    # The app reports most failures as a 200 page ('Invalid credentials!',
+    # 'Access Denied') or a redirect to /login, so check for the response a
+    # successful request gets rather than for an error status.
+    path = urlsplit(location or '').path
+    if scenario == 'register':
+        return status == 302 and path == '/login'
+    if scenario in ('login', 'deprovision'):
+        return status == 302 and path == '/dashboard'
+    if scenario == 'dashboard':
+        return status == 200 and b'<h2>Users</h2>' in body
+    raise ValueError(scenario)
+
+
+def check_admin_login(status, location):
+    if not succeeded('login', status, location, b''):
+        raise RuntimeError(f'could not log in as {ADMIN} (status {status}, location {location!r})')
+
+
+def summarize(timings, errors, wall):
+    timings = sorted(timings)
+    summary = {
+        'requests': len(timings),
+        'errors': errors,
+        'wall_seconds': wall,
+        'throughput_rps': len(timings) / wall if wall else 0.0,
+    }
+    if timings:
+        summary.update({
+            'mean_ms': sum(timings) / len(timings) * 1000,
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p95_ms': percentile(timings, 95) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+        })
+    return summary
+
+
+def plan(scenario, count, requests, seed):
+    # The requests a scenario makes, as (method, path, form) tuples. Scenarios
+    # run in SCENARIOS order, so deprovision never removes a user an earlier
+    # scenario needs, and it never removes admins.
+    rng = random.Random(f'{seed}-{scenario}')
+    if scenario == 'register':
+        return [('POST', '/register', {'username': f'bench{i:07d}', 'password': 'password', 'role': 'student'})
+                for i in range(requests)]
+    if scenario == 'login':
+        return [('POST', '/login', {'username': generate_users.username(rng.randrange(count)),
+                                    'password': generate_users.PASSWORD})
+                for _ in range(requests)]
+    if scenario == 'dashboard':
+        return [('GET', '/dashboard', None)] * requests
+    if scenario == 'deprovision':
+        candidates = [i for i in range(1, count) if generate_users.role(i) != 'admin']
+        victims = rng.sample(candidates, min(requests, len(candidates)))
+        return [('POST', '/deprovision', {'username': generate_users.username(i)}) for i in victims]
+    raise ValueError(scenario)
+
+
+def app_environment(workdir, backend, hash_method, hash_workers):
+    data_file = os.path.join(workdir, 'users.db' if backend == 'sqlite' else 'users.json')
+    return {
+        'USER_STORAGE': backend,
+        'USER_DATA_FILE': data_file,
+        'PASSWORD_HASH_METHOD': hash_method,
+        'PASSWORD_HASH_WORKERS': str(hash_workers),
+        # Workers must share sessions for the server runs.
+        'SESSION_STORE': 'sqlite',
+        'SESSION_DB_FILE': os.path.join(workdir, 'sessions.db'),
+    }
+
+
+def run_client_scenarios(env, count, requests, seed):
+    # Runs in a fresh (spawned) process so the app module picks up env.
+    os.environ.update(env)
+    import app as app_module
+
+    results = {}
+    try:
+        for scenario in SCENARIOS:
+            client = app_module.app.test_client()
+            if scenario in ('dashboard', 'deprovision'):
+                response = client.post('/login', data={'username': ADMIN, 'password': generate_users.PASSWORD})
+                check_admin_login(response.status_code, response.headers.get('Location'))
+            timings, errors = [], 0
+            wall_start = time.perf_counter()
+            for method, path, form in plan(scenario, count, requests, seed):
+                start = time.perf_counter()
+                response = client.open(path, method=method, data=form)
+                timings.append(time.perf_counter() - start)
+                errors += not succeeded(scenario, response.status_code, response.headers.get('Location'),
+                                        response.get_data())
+            results[scenario] = summarize(timings, errors, time.perf_counter() - wall_start)
+    finally:
+        app_module.hasher.shutdown()
+    return results
+
+
+class HttpClient:
+    # A minimal HTTP client that keeps the session cookie and does not follow
+    # redirects, so each timing is a single request.
+    def __init__(self, port):
+        self.port = port
+        self.cookies = SimpleCookie()
+
+    def request(self, method, path, form=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{key}={morsel.value}' for key, morsel in self.cookies.items())
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            for value in response.headers.get_all('Set-Cookie') or ():
+                self.cookies.load(value)
+            return response.status, response.headers.get('Location'), data
+        finally:
+            conn.close()
+
+
+def serve(port, workers):
+    # Pre-forks workers that all accept on one listening socket, like a
+    # gunicorn sync/threaded deployment.
+    from werkzeug.serving import make_server
+
+    import app as app_module
+
+    # Per-request access logging would dominate the timings.
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            server = make_server('127.0.0.1', port, app_module.app, threaded=True, fd=sock.fileno())
+            server.serve_forever()
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def run_server_scenarios(env, count, requests, seed, workers, concurrency):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', str(port), '--workers', str(workers)],
+        env=dict(os.environ, **env), cwd=REPO_DIR, start_new_session=True,
+    )
+    try:
+        wait_for_port(port)
+        results = {}
+        for scenario in SCENARIOS:
+            requests_plan = plan(scenario, count, requests, seed)
+            clients = [HttpClient(port) for _ in range(concurrency)]
+            if scenario in ('dashboard', 'deprovision'):
+                for client in clients:
+                    status, location, _ = client.request(
+                        'POST', '/login', {'username': ADMIN, 'password': generate_users.PASSWORD})
+                    check_admin_login(status, location)
+
+            def drive(worker):
+                client, timings, errors = clients[worker], [], 0
+                for method, path, form in requests_plan[worker::concurrency]:
+                    start = time.perf_counter()
+                    status, location, body = client.request(method, path, form)
+                    timings.append(time.perf_counter() - start)
+                    errors += not succeeded(scenario, status, location, body)
+                return timings, errors
+
+            wall_start = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                outcomes = list(pool.map(drive, range(concurrency)))
+            wall = time.perf_counter() - wall_start
+            timings = [t for worker_timings, _ in outcomes for t in worker_timings]
+            results[scenario] = summarize(timings, sum(errors for _, errors in outcomes), wall)
+        return results
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    return git('rev-parse', '--short', 'HEAD') or 'unknown', bool(git('status', '--porcelain', '--untracked-files=no'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--backend', default='json', choices=['json', 'journal', 'sqlite'])
+    parser.add_argument('--mode', default='client', choices=['client', 'server'])
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--workers', type=int, default=4, help='server processes (server mode)')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads (server mode)')
+    parser.add_argument('--hash-method', default=generate_users.HASH_METHOD,
+                        help='KDF for registrations; the default matches the synthetic users')
+    parser.add_argument('--hash-workers', type=int, default=0, help='KDF pool size (0 hashes inline)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<time>-<commit>.json)')
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.workers)
+        return
+
+    commit, dirty = git_revision()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('serve', 'output')},
+        'runs': [],
+    }
+
+    spawn = multiprocessing.get_context('spawn')
+    for count in args.users:
+        with tempfile.TemporaryDirectory() as workdir:
+            env = app_environment(workdir, args.backend, args.hash_method, args.hash_workers)
+            generate_users.generate(env['USER_DATA_FILE'], count, args.backend)
+            if args.mode == 'client':
+                # Not a multiprocessing.Pool: its workers are daemonic and
+                # could not start the app's hashing pool.
+                with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+                    scenarios = pool.submit(run_client_scenarios, env, count, args.requests, args.seed).result()
+            else:
+                scenarios = run_server_scenarios(env, count, args.requests, args.seed,
+                                                 args.workers, args.concurrency)
+        report['runs'].append({'users': count, 'backend': args.backend, 'mode': args.mode,
+                               'scenarios': scenarios})
+        for scenario, summary in scenarios.items():
+            print(f"{count:>9} users  {scenario:<12} {summary['throughput_rps']:9.1f} req/s  "
+                  f"p50 {summary.get('p50_ms', 0):8.2f} ms  p95 {summary.get('p95_ms', 0):8.2f} ms  "
+                  f"p99 {summary.get('p99_ms', 0):8.2f} ms  errors {summary['errors']}")
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        output = os.path.join(BENCH_DIR, 'results', f'{stamp}-{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f'results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import csv
+import json
+import logging
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+
+def upload_format(request):
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'csv' if request.mimetype in ('text/csv', 'application/csv') else 'jsonl'
+    if fmt not in ('csv', 'jsonl'):
+        raise ValueError(f'unsupported upload format: {fmt!r}')
+    return fmt
+
+
+def _decoded_lines(stream):
+    # Decodes the body one line at a time, so a line that is not valid UTF-8
+    # only fails that line. Yields each line, or None if it cannot be decoded.
+    for line in stream:
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            yield None
+
+
+def iter_rows(stream, fmt):
+    # Parses an uploaded CSV (with a header row) or JSONL body one line at a
+    # time. Yields a dict per record, or an error message for records that
+    # cannot be parsed. CSV records must fit on one line.
+    lines = _decoded_lines(stream)
+    if fmt == 'csv':
+        header = next(lines, None)
+        if header is None:
+            return
+        if header.startswith('\ufeff'):
+            header = header[1:]
+        fieldnames = next(csv.reader([header]), [])
+    for line in lines:
+        if line is None:
+            yield 'invalid UTF-8'
+            continue
+        if not line.strip():
+            continue
+        if fmt == 'csv':
+            yield dict(zip(fieldnames, next(csv.reader([line]))))
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield 'malformed JSON'
+            continue
+        yield row if isinstance(row, dict) else 'expected a JSON object'
+
+
+def _field(row, name, strip=True):
+    # Missing and non-string values both come back as ''.
+    value = row.get(name)
+    if not isinstance(value, str):
+        return ''
+    return value.strip() if strip else value
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def provision(rows, store, hasher, directory=None, roles=None, chunk_size=256):
+    # Validates and hashes rows chunk by chunk, reporting each row as
+    # "validated" or "rejected" as it goes, then adds every validated user in
+    # a single storage write. If roles is given, rows with any other role are
+    # rejected. Yields report records; the last one is the summary, which
+    # says how many users were actually created.
+    roles = None if roles is None else set(roles)
+    seen = set()
+    validated = []
+    rows_by_name = {}
+    rejected = 0
+    for chunk in _chunks(enumerate(rows, 1), chunk_size):
+        valid = []
+        for row_number, row in chunk:
+            if isinstance(row, str):
+                error, username = row, None
+            else:
+                # Usernames are taken as given, like /register does.
+                username = _field(row, 'username', strip=False)
+                password = _field(row, 'password', strip=False)
+                role = _field(row, 'role')
+                if not (username and password and role):
+                    error = 'username, password and role are required strings'
+                elif roles is not None and role not in roles:
+                    error = f'unknown role {role!r}'
+                elif username in seen:
+                    error = 'duplicate username in upload'
+                elif store.get_user(username) is not None:
+                    error = 'user already exists'
+                else:
+                    error = None
+            if error:
+                rejected += 1
+                yield {'row': row_number, 'username': username, 'status': 'rejected', 'error': error}
+                continue
+            seen.add(username)
+            valid.append((row_number, username, password, role))
+
+        hashes = hasher.hash_many([password for _, _, password, _ in valid])
+        for (row_number, username, _, role), hashed_password in zip(valid, hashes):
+            validated.append({'username': username, 'password': hashed_password, 'role': role})
+            rows_by_name[username] = row_number
+            yield {'row': row_number, 'username': username, 'status': 'validated'}
+
+    try:
+        skipped = store.add_many(validated) if validated else []
+    except Exception:
+        logger.exception('bulk provisioning commit failed')
+        yield {'summary': {'created': 0, 'rejected': rejected, 'error': 'commit failed, no users were created'}}
+        return
+
+    # Another writer may have taken some of the names since they were checked.
+    for username in skipped:
+        yield {'row': rows_by_name[username], 'username': username, 'status': 'rejected',
+               'error': 'user already exists'}
+    if directory is not None:
+        skipped_names = set(skipped)
+        directory.add_many((user['username'], user['role']) for user in validated
+                           if user['username'] not in skipped_names)
+    yield {'summary': {'created': len(validated) - len(skipped), 'rejected': rejected + len(skipped)}}
+
+
+def deprovision(rows, store, session_store=None, directory=None):
+    # Reports each row as "validated" or "rejected" as it is read, then
+    # deletes every found user in a single storage write and revokes their
+    # sessions. Yields report records; the last one is the summary, which
+    # says how many users were actually deleted.
+    found = {}
+    rejected = 0
+    for row_number, row in enumerate(rows, 1):
+        username = None if isinstance(row, str) else _field(row, 'username', strip=False)
+        if isinstance(row, str) or not username:
+            error = row if isinstance(row, str) else 'username is required'
+        elif username in found:
+            error = 'duplicate username in upload'
+        elif store.get_user(username) is None:
+            error = 'no such user'
+        else:
+            error = None
+        if error:
+            rejected += 1
+            yield {'row': row_number, 'username': username, 'status': 'rejected', 'error': error}
+            continue
+        found[username] = row_number
+        yield {'row': row_number, 'username': username, 'status': 'validated'}
+
+    try:
+        deleted = store.delete_many(list(found)) if found else 0
+    except Exception:
+        logger.exception('bulk deprovisioning commit failed')
+        yield {'summary': {'deleted': 0, 'rejected': rejected, 'error': 'commit failed, no users were deleted'}}
+        return
+
+    if session_store is not None:
+        for username in found:
+            session_store.revoke_user(username)
+    if directory is not None:
+        directory.remove_many(found)
+    yield {'summary': {'deleted': deleted, 'rejected': rejected + len(found) - deleted}}
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+
+class UserDirectory:
+    # Sorted username index for browsing users: a sorted list of all
+    # usernames plus one per role, so a page is a couple of bisects and a
+    # slice. It is first built on a background thread at startup; the routes
+    # then update it as users are added or removed, and record the store's
+    # generation after their own write so it does not trigger a rebuild.
+    # Changes made by other workers are noticed through store.generation(),
+    # checked at most every check_interval seconds; the index is then rebuilt
+    # on a background thread and swapped in, while requests keep using the
+    # old one.
+    def __init__(self, store, check_interval=1.0):
+        self.store = store
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._built = False
+        self._generation = None
+        self._checked_at = 0.0
+        self._rebuilding = False
+        self._names = []
+        self._by_role = {}
+        self._roles = {}
+        os.register_at_fork(after_in_child=self._after_fork)
+        self._start_rebuild()
+
+    def _after_fork(self):
+        # Only the forking thread survives, so a build that was running in
+        # the parent has to be started again.
+        self._lock = threading.Lock()
+        if self._rebuilding:
+            self._start_rebuild()
+
+    def _build(self):
+        # Read the generation first, so a write that lands during the build
+        # triggers another one.
+        generation = self.store.generation()
+        roles = {user['username']: user['role'] for user in self.store.list_users()}
+        by_role = {}
+        for username, role in roles.items():
+            by_role.setdefault(role, []).append(username)
+        for names in by_role.values():
+            names.sort()
+        return generation, sorted(roles), by_role, roles
+
+    def _start_rebuild(self):
+        self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _rebuild_in_background(self):
+        try:
+            built = self._build()
+            with self._lock:
+                self._generation, self._names, self._by_role, self._roles = built
+                self._built = True
+                self._checked_at = time.monotonic()
+        finally:
+            self._rebuilding = False
+            self._ready.set()
+
+    def _ensure_fresh(self):
+        # Caller holds self._lock.
+        now = time.monotonic()
+        if self._rebuilding or now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        generation = self.store.generation()
+        if not self._built or (generation is not None and generation != self._generation):
+            self._start_rebuild()
+
+    def _sync_generation(self):
+        # Caller holds self._lock.
+        if self._built:
+            self._generation = self.store.generation()
+
+    def sync_generation(self):
+        # Records that the index reflects the store as it is now, after a
+        # write that does not change any username or role, e.g. a password
+        # rehash.
+        with self._lock:
+            self._sync_generation()
+
+    @staticmethod
+    def _discard(names, username):
+        i = bisect_left(names, username)
+        if i < len(names) and names[i] == username:
+            del names[i]
+
+    def add(self, username, role):
+        with self._lock:
+            if not self._built or username in self._roles:
+                return
+            self._roles[username] = role
+            insort(self._names, username)
+            insort(self._by_role.setdefault(role, []), username)
+            self._sync_generation()
+
+    def add_many(self, users):
+        # Merges a batch of (username, role) pairs in one pass per list
+        # rather than one insort per user.
+        with self._lock:
+            if not self._built:
+                return
+            added = {}
+            for username, role in users:
+                if username not in self._roles:
+                    self._roles[username] = added[username] = role
+            if not added:
+                return
+            # Sorting two concatenated sorted runs is a linear merge.
+            self._names = sorted(self._names + sorted(added))
+            new_by_role = {}
+            for username, role in added.items():
+                new_by_role.setdefault(role, []).append(username)
+            for role, names in new_by_role.items():
+                self._by_role[role] = sorted(self._by_role.get(role, []) + sorted(names))
+            self._sync_generation()
+
+    def remove(self, username):
+        with self._lock:
+            role = self._roles.pop(username, None)
+            if role is None:
+                return
+            self._discard(self._names, username)
+            self._discard(self._by_role[role], username)
+            self._sync_generation()
+
+    def remove_many(self, usernames):
+        # Drops a batch of users with one filtering pass per list.
+        with self._lock:
+            removed = {username for username in usernames if self._roles.pop(username, None) is not None}
+            if not removed:
+                return
+            self._names = [name for name in self._names if name not in removed]
+            for role, names in self._by_role.items():
+                self._by_role[role] = [name for name in names if name not in removed]
+            self._sync_generation()
+
+    def page(self, prefix='', role=None, cursor=None, limit=50):
+        # Returns up to limit (username, role) pairs in username order that
+        # start with prefix (and have the given role), after cursor, which is
+        # the last username of the previous page. The second value is the
+        # cursor for the next page, or None on the last page. Waits for the
+        # initial build.
+        self._ready.wait()
+        with self._lock:
+            self._ensure_fresh()
+            names = self._by_role.get(role, []) if role else self._names
+            start = bisect_left(names, prefix)
+            if cursor is not None:
+                start = max(start, bisect_right(names, cursor))
+            stop = bisect_left(names, prefix + '\U0010ffff') if prefix else len(names)
+            end = min(start + limit, stop)
+            users = [(username, self._roles[username]) for username in names[start:end]]
+        next_cursor = users[-1][0] if users and end < stop else None
+        return users, next_cursor
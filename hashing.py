@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import metrics
+
+
+class Overloaded(Exception):
+    # Raised when too many hashing jobs are already queued.
+    pass
+
+
+def _timed_call(fn, *args):
+    # Runs in the pool worker, so the time excludes queueing and pickling.
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _pool_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+class PasswordHasher:
+    # Runs the (deliberately slow) password KDF in a process pool so it does
+    # not hold the request threads or the GIL. At most max_pending jobs may be
+    # queued or running at once; beyond that Overloaded is raised instead of
+    # letting a login storm queue up unbounded work. With workers=0 hashing
+    # runs inline on the calling thread.
+    def __init__(self, method='scrypt', workers=None, max_pending=None):
+        self.method = method
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or max(self.workers, 1) * 4
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._method_prefix = None
+
+    def _executor(self):
+        # A pool inherited over fork has no live workers in this process. The
+        # pool starts its workers lazily from request threads, when other
+        # threads may hold locks, so they come from a forkserver (or are
+        # spawned) rather than forked from this process.
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def shutdown(self):
+        # Stops the pool's workers, e.g. before leaving a multiprocessing
+        # child, which would otherwise wait for them forever on exit.
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pool_pid == os.getpid():
+            pool.shutdown()
+
+    def _run(self, op, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded()
+        try:
+            start = time.perf_counter()
+            if self.workers == 0:
+                result, elapsed = _timed_call(fn, *args)
+            else:
+                result, elapsed = self._executor().submit(_timed_call, fn, *args).result()
+            metrics.kdf_wait_seconds.observe(time.perf_counter() - start, op=op)
+            metrics.kdf_seconds.observe(elapsed, op=op)
+            return result
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords):
+        # Bulk jobs wait for a queue slot rather than failing, and take only
+        # one. They also keep at most one job per worker in the pool at a
+        # time, so a login submitted meanwhile waits behind at most one KDF
+        # per worker instead of the whole batch.
+        with self._slots:
+            hash_one = partial(_timed_call, generate_password_hash)
+            if self.workers == 0:
+                results = [hash_one(password, self.method) for password in passwords]
+            else:
+                executor = self._executor()
+                results, in_flight = [], deque()
+                for password in passwords:
+                    if len(in_flight) >= self.workers:
+                        results.append(in_flight.popleft().result())
+                    in_flight.append(executor.submit(hash_one, password, self.method))
+                results.extend(future.result() for future in in_flight)
+        for _, elapsed in results:
+            metrics.kdf_seconds.observe(elapsed, op='hash')
+        return [pwhash for pwhash, _ in results]
+
+    def verify(self, pwhash, password):
+        return self._run('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # Hashes look like "method$salt$hash", with the cost parameters spelled
+        # out in the method part (e.g. "scrypt:32768:8:1"). Hash once with the
+        # configured method, through the pool like any other job, to learn its
+        # full spelling. May raise Overloaded.
+        if self._method_prefix is None:
+            self._method_prefix = self._run('hash', generate_password_hash, '', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._method_prefix
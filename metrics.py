@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cached lookup up to a slow KDF.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    # Values are kept per process, keyed by the tuple of label values. With
+    # several workers each one exposes its own numbers, so the registry adds
+    # a pid label (see Registry.render).
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, list(zip(self.labelnames, key)), value
+
+    def render(self, const_labels=()):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self._samples():
+            lines.append(f'{name}{_format_labels(list(const_labels) + labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        if self.callback is not None:
+            yield self.name, [], self.callback()
+            return
+        yield from super()._samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2]))
+                           for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', labels + [('le', _format_value(bound))], cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4. A scrape is
+        # answered by whichever worker takes it, so every sample carries that
+        # worker's pid; otherwise the series would jump between workers'
+        # values. Aggregate across workers with sum without (pid).
+        const_labels = [('pid', os.getpid())]
+        return '\n'.join(metric.render(const_labels) for metric in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+request_seconds = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request.', ('route', 'method', 'status')))
+template_seconds = REGISTRY.register(Histogram(
+    'template_render_duration_seconds', 'Time spent rendering a template.', ('template',)))
+storage_seconds = REGISTRY.register(Histogram(
+    'storage_operation_duration_seconds', 'Time spent in user storage operations.', ('backend', 'op')))
+storage_bytes = REGISTRY.register(Counter(
+    'storage_bytes_total', 'Bytes read from or written to user storage files.', ('direction',)))
+kdf_seconds = REGISTRY.register(Histogram(
+    'password_kdf_duration_seconds', 'Time spent inside the password KDF.', ('op',)))
+kdf_wait_seconds = REGISTRY.register(Histogram(
+    'password_kdf_wait_seconds', 'Time from submitting a KDF job until its result is back.', ('op',)))
+logins = REGISTRY.register(Counter(
+    'logins_total', 'Login attempts by outcome.', ('result',)))
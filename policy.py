@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import redirect, session, url_for
+
+logger = logging.getLogger(__name__)
+
+
+class PolicyError(Exception):
+    pass
+
+
+class Policy:
+    # A compiled role -> permission policy. Each permission gets one bit and
+    # each role a mask of every permission it has, inheritance included, so a
+    # check is a dict lookup and a single AND.
+    def __init__(self, bits, masks):
+        self.bits = bits
+        self.masks = masks
+
+    @property
+    def roles(self):
+        return list(self.masks)
+
+    def allows(self, role, permission):
+        return bool(self.masks.get(role, 0) & self.bits.get(permission, 0))
+
+
+def compile_policy(data):
+    roles = data.get('roles') if isinstance(data, dict) else None
+    if not isinstance(roles, dict):
+        raise PolicyError('policy needs a "roles" object')
+    for role, spec in roles.items():
+        if not isinstance(spec, dict):
+            raise PolicyError(f'role {role!r} must be an object')
+        for key in ('permissions', 'inherits'):
+            values = spec.get(key, [])
+            if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+                raise PolicyError(f'{key!r} of role {role!r} must be a list of strings')
+
+    bits = {}
+    for spec in roles.values():
+        for permission in spec.get('permissions', []):
+            bits.setdefault(permission, 1 << len(bits))
+
+    masks = {}
+
+    def resolve(role, path):
+        if role in masks:
+            return masks[role]
+        if role not in roles:
+            raise PolicyError(f'unknown role {role!r} inherited by {path[-1]!r}')
+        if role in path:
+            raise PolicyError('role inheritance cycle: ' + ' -> '.join(path + (role,)))
+        spec = roles[role]
+        mask = 0
+        for permission in spec.get('permissions', []):
+            mask |= bits[permission]
+        for parent in spec.get('inherits', []):
+            mask |= resolve(parent, path + (role,))
+        masks[role] = mask
+        return mask
+
+    for role in roles:
+        resolve(role, ())
+    return Policy(bits, masks)
+
+
+def load_policy(path):
+    with open(path, 'r') as f:
+        return compile_policy(json.load(f))
+
+
+class PolicyEngine:
+    # Serves decisions from the compiled policy and picks up edits to the
+    # policy file without a restart: the file is stat'ed at most once every
+    # reload_interval seconds and recompiled when it changes. A file that
+    # fails to compile is logged and the previous policy is kept.
+    def __init__(self, path, reload_interval=1.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._stamp = self._file_stamp()
+        self._policy = load_policy(path)
+        self._checked_at = time.monotonic()
+
+    def _file_stamp(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            try:
+                stamp = self._file_stamp()
+            except OSError as e:
+                stamp, error = None, e
+            if stamp == self._stamp:
+                return
+            # Remember the stamp even if the file fails to compile, so a bad
+            # edit is reported once and retried only when it changes again.
+            self._stamp = stamp
+            try:
+                if stamp is None:
+                    raise error
+                self._policy = load_policy(self.path)
+            except (OSError, ValueError, PolicyError) as e:
+                logger.warning('keeping previous policy, could not reload %s: %s', self.path, e)
+
+    @property
+    def policy(self):
+        self._maybe_reload()
+        return self._policy
+
+    def allows(self, role, permission):
+        return self.policy.allows(role, permission)
+
+    def can(self, permission):
+        # Whether the current session's role has the permission.
+        return 'username' in session and self.allows(session.get('role'), permission)
+
+    def requires(self, permission):
+        # Sends anonymous users to the login page and answers 'Access Denied'
+        # to users whose role lacks the permission.
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if 'username' not in session:
+                    return redirect(url_for('login'))
+                if not self.can(permission):
+                    return 'Access Denied'
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
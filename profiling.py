@@ -0,0 +1,41 @@
+import cProfile
+import os
+import random
+import threading
+import time
+
+from flask import g, request
+
+
+class SlowRequestProfiler:
+    # Runs cProfile on a sample of requests and dumps the profile of any that
+    # took longer than threshold seconds into directory, for inspection with
+    # pstats or snakeviz. Only one request is profiled at a time.
+    def __init__(self, app, threshold, sample_rate=1.0, directory='profiles'):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self._busy = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        app.before_request(self._start)
+        app.teardown_request(self._stop)
+
+    def _start(self):
+        if random.random() >= self.sample_rate or not self._busy.acquire(blocking=False):
+            return
+        g.profiler = cProfile.Profile()
+        g.profile_start = time.perf_counter()
+        g.profiler.enable()
+
+    def _stop(self, exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        try:
+            elapsed = time.perf_counter() - g.pop('profile_start')
+            if elapsed >= self.threshold:
+                name = f'{time.time_ns()}-{request.endpoint or "unmatched"}-{elapsed * 1000:.0f}ms.prof'
+                profiler.dump_stats(os.path.join(self.directory, name))
+        finally:
+            self._busy.release()
@@ -0,0 +1,175 @@
+import json
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from storage import ConnectionPool
+
+
+class MemorySessionStore:
+    # Sessions kept in this process, in least-recently-used order, with an
+    # index from username to session ids so all of a user's sessions can be
+    # revoked without scanning. Sessions expire ttl seconds after they were
+    # last saved; beyond max_entries the least recently used are evicted.
+    def __init__(self, ttl=8 * 3600, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._by_user = {}
+
+    def _remove(self, sid):
+        data, username, _ = self._sessions.pop(sid)
+        if username is not None:
+            sids = self._by_user[username]
+            sids.discard(sid)
+            if not sids:
+                del self._by_user[username]
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                self._remove(sid)
+                return None
+            self._sessions.move_to_end(sid)
+            return dict(entry[0])
+
+    def save(self, sid, data, username):
+        with self._lock:
+            if sid in self._sessions:
+                self._remove(sid)
+            self._sessions[sid] = (dict(data), username, time.time() + self.ttl)
+            if username is not None:
+                self._by_user.setdefault(username, set()).add(sid)
+            while len(self._sessions) > self.max_entries:
+                self._remove(next(iter(self._sessions)))
+
+    def delete(self, sid):
+        with self._lock:
+            if sid in self._sessions:
+                self._remove(sid)
+
+    def revoke_user(self, username):
+        with self._lock:
+            for sid in list(self._by_user.get(username, ())):
+                self._remove(sid)
+
+
+class SqliteSessionStore:
+    # Sessions shared by every worker through an SQLite table keyed by session
+    # id, with an index on username for revocation. Sessions expire ttl
+    # seconds after they were last saved; beyond max_entries the least
+    # recently saved are evicted. Unlike MemorySessionStore this is not LRU:
+    # a read does not count as use, since recording it would turn every
+    # request into a write.
+    def __init__(self, path, ttl=8 * 3600, max_entries=100000, busy_timeout=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        self._pool = ConnectionPool(path, busy_timeout)
+        with self._pool.connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                ' sid TEXT PRIMARY KEY,'
+                ' username TEXT,'
+                ' data TEXT NOT NULL,'
+                ' expires REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username)')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+
+    def get(self, sid):
+        with self._pool.connection() as conn:
+            row = conn.execute(
+                'SELECT data FROM sessions WHERE sid = ? AND expires > ?', (sid, time.time())
+            ).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def save(self, sid, data, username):
+        now = time.time()
+        with self._pool.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions (sid, username, data, expires) VALUES (?, ?, ?, ?)',
+                (sid, username, json.dumps(data), now + self.ttl),
+            )
+            # Trimming scans the expires index, so only do it now and then.
+            if random.randrange(100) == 0:
+                conn.execute('DELETE FROM sessions WHERE expires <= ?', (now,))
+                conn.execute(
+                    'DELETE FROM sessions WHERE sid IN (SELECT sid FROM sessions'
+                    ' ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_entries,)
+                )
+
+    def delete(self, sid):
+        with self._pool.connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def revoke_user(self, username):
+        with self._pool.connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE username = ?', (username,))
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.loaded_username = self.get('username')
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    # Keeps session data in a session store and only a random session id in
+    # the cookie, so sessions can be revoked on the server. Looking up the id
+    # is the only per-request check.
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        data = self.store.get(sid) if sid else None
+        if data is None:
+            return ServerSession()
+        return ServerSession(data, sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        # Hand out a new id whenever the logged-in user changes, so an id
+        # issued before login cannot be reused afterwards.
+        if session.sid is None or session.get('username') != session.loaded_username:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+            session.loaded_username = session.get('username')
+        self.store.save(session.sid, dict(session), session.get('username'))
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
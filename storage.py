@@ -0,0 +1,685 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+def _fsync_dir(path):
+    # Makes a rename in the directory holding path durable.
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class UserStore(ABC):
+    # Interface the routes use to reach user records. Users are dicts with
+    # 'username', 'password' (a password hash) and 'role' keys.
+    @abstractmethod
+    def get_user(self, username):
+        pass
+
+    @abstractmethod
+    def add_user(self, user):
+        # Returns False if the username is already taken.
+        pass
+
+    @abstractmethod
+    def add_many(self, users):
+        # Adds all given users in one write, skipping usernames that are
+        # already taken; returns the skipped usernames.
+        pass
+
+    @abstractmethod
+    def update_user(self, user):
+        # Replaces an existing user; returns False if there was no such user.
+        pass
+
+    @abstractmethod
+    def delete_user(self, username):
+        # Returns False if there was no such user.
+        pass
+
+    @abstractmethod
+    def delete_many(self, usernames):
+        # Deletes all given users in one write; returns how many existed.
+        pass
+
+    @abstractmethod
+    def list_users(self):
+        pass
+
+    def generation(self):
+        # A cheap token that changes whenever any process changes the users,
+        # or None if the store cannot tell.
+        return None
+
+    def __len__(self):
+        return len(self.list_users())
+
+
+class JsonUserStore(UserStore):
+    # Keeps the users from the JSON file in a dict keyed by username, so
+    # lookups are O(1). The file is only re-parsed when it changes, e.g. after
+    # another worker has written to it. Writes go to a temporary file that is
+    # renamed over the old one, so readers (and a crash) never see a partial
+    # file; concurrent writers in different workers still overwrite each
+    # other's changes.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._users = {}
+        self._stamp = None
+        if not os.path.exists(path):
+            self._write()
+
+    def _file_stamp(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _refresh(self):
+        if self._file_stamp() != self._stamp:
+            with open(self.path, 'r') as f:
+                # Stamp the file actually read, in case it was replaced again
+                # since the stat above.
+                st = os.fstat(f.fileno())
+                stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+                users = json.load(f)
+            self._users = {user['username']: user for user in users}
+            self._stamp = stamp
+            metrics.storage_bytes.inc(stamp[2], direction='read')
+
+    def _write(self):
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(list(self._users.values()), f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        os.replace(tmp, self.path)
+        self._stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        metrics.storage_bytes.inc(st.st_size, direction='write')
+
+    def get_user(self, username):
+        with self._lock:
+            self._refresh()
+            return self._users.get(username)
+
+    def add_user(self, user):
+        with self._lock:
+            self._refresh()
+            if user['username'] in self._users:
+                return False
+            self._users[user['username']] = user
+            self._write()
+            return True
+
+    def add_many(self, users):
+        with self._lock:
+            self._refresh()
+            skipped = []
+            for user in users:
+                if user['username'] in self._users:
+                    skipped.append(user['username'])
+                else:
+                    self._users[user['username']] = user
+            if len(skipped) < len(users):
+                self._write()
+            return skipped
+
+    def update_user(self, user):
+        with self._lock:
+            self._refresh()
+            if user['username'] not in self._users:
+                return False
+            self._users[user['username']] = user
+            self._write()
+            return True
+
+    def delete_user(self, username):
+        with self._lock:
+            self._refresh()
+            if self._users.pop(username, None) is None:
+                return False
+            self._write()
+            return True
+
+    def delete_many(self, usernames):
+        with self._lock:
+            self._refresh()
+            deleted = sum(self._users.pop(username, None) is not None
+                          for username in set(usernames))
+            if deleted:
+                self._write()
+            return deleted
+
+    def list_users(self):
+        with self._lock:
+            self._refresh()
+            return list(self._users.values())
+
+    def generation(self):
+        return self._file_stamp()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._users)
+
+
+class JournalUserStore(UserStore):
+    # Stores users as a snapshot (the same JSON list as JsonUserStore) plus an
+    # append-only JSONL journal of add/delete records, so a write costs one
+    # appended line instead of rewriting the whole file. Every worker replays
+    # the journal tail it has not seen yet, so several processes can share one
+    # store; writers are serialized with an flock on a sidecar lock file.
+    #
+    # Journal records are blind sets/deletes keyed by username, so replaying a
+    # record that is already reflected in the snapshot is harmless. That is
+    # what makes a crash between the two renames of a compaction safe.
+    def __init__(self, path, compact_bytes=4 * 1024 * 1024, commit_delay=0.0):
+        if fcntl is None:
+            raise RuntimeError('the journal store requires fcntl (POSIX only)')
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.lock_path = path + '.lock'
+        self.compact_bytes = compact_bytes
+        self.commit_delay = commit_delay
+
+        self._lock = threading.RLock()
+        self._users = {}
+        self._generation = None
+        self._offset = 0
+        self._journal = None
+        self._journal_ino = None
+        self._compacting = False
+
+        # Group commit: writers append under the lock and then wait for one
+        # fsync that covers every record written so far.
+        self._sync_cond = threading.Condition()
+        self._sync_journal = None
+        self._syncing = False
+        self._written_seq = 0
+        self._synced_seq = 0
+
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                json.dump([], f)
+        open(self.journal_path, 'ab').close()
+        self._lock_file = None
+        self._lock_pid = None
+
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+
+    @contextmanager
+    def _file_lock(self, mode):
+        # flock locks belong to the open file, which forked workers would
+        # share, so each process opens the lock file itself.
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(self.lock_path, 'ab')
+            self._lock_pid = os.getpid()
+        fd = self._lock_file.fileno()
+        fcntl.flock(fd, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _current_generation(self):
+        snap = os.stat(self.path)
+        journal = os.stat(self.journal_path)
+        return (snap.st_ino, snap.st_mtime_ns, snap.st_size, journal.st_ino)
+
+    def _apply(self, record):
+        if record['op'] == 'add':
+            self._users[record['user']['username']] = record['user']
+        elif record['op'] == 'delete':
+            self._users.pop(record['username'], None)
+
+    def _refresh(self):
+        # Caller holds self._lock and at least a shared file lock.
+        generation = self._current_generation()
+        if generation != self._generation:
+            # The store was compacted (or this is the first load): start over
+            # from the new snapshot.
+            with open(self.path, 'r') as f:
+                self._users = {user['username']: user for user in json.load(f)}
+            self._generation = generation
+            self._offset = 0
+            metrics.storage_bytes.inc(generation[2], direction='read')
+
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        metrics.storage_bytes.inc(len(data), direction='read')
+        # Only whole lines are applied; a torn record left by a crash is
+        # ignored and truncated by the next writer.
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                self._apply(json.loads(line))
+        self._offset += end
+
+    def _journal_file(self):
+        if self._generation[3] != self._journal_ino:
+            self._journal = open(self.journal_path, 'ab')
+            self._journal_ino = self._generation[3]
+        return self._journal
+
+    def _append(self, records):
+        # Caller holds self._lock and the exclusive file lock, and has just
+        # called _refresh().
+        journal = self._journal_file()
+        if os.fstat(journal.fileno()).st_size > self._offset:
+            journal.truncate(self._offset)
+        data = b''.join(json.dumps(record).encode() + b'\n' for record in records)
+        journal.write(data)
+        journal.flush()
+        metrics.storage_bytes.inc(len(data), direction='write')
+        for record in records:
+            self._apply(record)
+        self._offset += len(data)
+        with self._sync_cond:
+            self._written_seq += 1
+            self._sync_journal = journal
+            return self._written_seq
+
+    def _commit(self, seq):
+        with self._sync_cond:
+            while self._synced_seq < seq:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                self._sync_cond.release()
+                try:
+                    if self.commit_delay:
+                        time.sleep(self.commit_delay)
+                    # Records written before a compaction were fsynced into
+                    # the new journal by it, so syncing the latest file
+                    # covers everything up to target.
+                    with self._sync_cond:
+                        target = self._written_seq
+                        journal = self._sync_journal
+                    os.fsync(journal.fileno())
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                self._synced_seq = max(self._synced_seq, target)
+                self._sync_cond.notify_all()
+
+        if self._offset >= self.compact_bytes:
+            self._start_compaction()
+
+    def get_user(self, username):
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+            return self._users.get(username)
+
+    def add_user(self, user):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            if user['username'] in self._users:
+                return False
+            seq = self._append([{'op': 'add', 'user': user}])
+        self._commit(seq)
+        return True
+
+    def add_many(self, users):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            skipped, records, seen = [], [], set()
+            for user in users:
+                if user['username'] in self._users or user['username'] in seen:
+                    skipped.append(user['username'])
+                else:
+                    seen.add(user['username'])
+                    records.append({'op': 'add', 'user': user})
+            if not records:
+                return skipped
+            seq = self._append(records)
+        self._commit(seq)
+        return skipped
+
+    def update_user(self, user):
+        # 'add' records overwrite, so they double as updates.
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            if user['username'] not in self._users:
+                return False
+            seq = self._append([{'op': 'add', 'user': user}])
+        self._commit(seq)
+        return True
+
+    def delete_user(self, username):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            if username not in self._users:
+                return False
+            seq = self._append([{'op': 'delete', 'username': username}])
+        self._commit(seq)
+        return True
+
+    def delete_many(self, usernames):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            existing = [username for username in dict.fromkeys(usernames)
+                        if username in self._users]
+            if not existing:
+                return 0
+            seq = self._append([{'op': 'delete', 'username': username}
+                                for username in existing])
+        self._commit(seq)
+        return len(existing)
+
+    def list_users(self):
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+            return list(self._users.values())
+
+    def generation(self):
+        # Compaction changes the inodes; every write grows the journal.
+        return self._current_generation() + (os.stat(self.journal_path).st_size,)
+
+    def __len__(self):
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+            return len(self._users)
+
+    def _start_compaction(self):
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def compact(self):
+        # Take a consistent copy of the state and write the snapshot without
+        # holding any lock, then swap it in together with whatever journal
+        # records were appended in the meantime.
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+            users = list(self._users.values())
+            generation = self._generation
+            covered = self._offset
+
+        snapshot_tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(snapshot_tmp, 'w') as f:
+            json.dump(users, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+            metrics.storage_bytes.inc(f.tell(), direction='write')
+
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            if self._current_generation() != generation:
+                # Another worker compacted first.
+                os.unlink(snapshot_tmp)
+                return
+            self._refresh()
+            with open(self.journal_path, 'rb') as f:
+                f.seek(covered)
+                tail = f.read(self._offset - covered)
+            journal_tmp = f'{self.journal_path}.{os.getpid()}.tmp'
+            with open(journal_tmp, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            # The snapshot rename must be durable before the journal one, or
+            # a power loss could keep the old snapshot with the new, tail-only
+            # journal.
+            os.replace(snapshot_tmp, self.path)
+            _fsync_dir(self.path)
+            os.replace(journal_tmp, self.journal_path)
+            _fsync_dir(self.journal_path)
+            self._generation = self._current_generation()
+            self._offset = len(tail)
+
+
+def _row_bytes(user):
+    # SQLite does not report I/O per statement, so the byte counters for it
+    # count the encoded size of the user rows read and written.
+    return len(user['username'].encode()) + len(user['password'].encode()) + len(user['role'].encode())
+
+
+class ConnectionPool:
+    # A small per-process pool of SQLite connections in autocommit and WAL
+    # mode. Connections are checked out for one operation and returned, so
+    # they are reused across requests whether the server runs a thread per
+    # request or a fixed set of threads. At most size idle connections are
+    # kept. A pool inherited over fork starts empty, since SQLite
+    # connections must not be used in more than one process.
+    def __init__(self, path, busy_timeout=5.0, size=8):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        # Connections left behind by the parent are kept referenced rather
+        # than closed (or collected) here.
+        self._inherited = []
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                               isolation_level=None, check_same_thread=False,
+                               cached_statements=64)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._inherited.extend(self._idle)
+                self._idle = []
+                self._pid = os.getpid()
+            conn = self._idle.pop() if self._idle else None
+            pid = self._pid
+        if conn is None:
+            conn = self._open()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                if self._pid == pid and len(self._idle) < self.size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+
+class SqliteUserStore(UserStore):
+    # Keeps users in an SQLite table with a unique index on username, so
+    # lookups and deletes are O(log N) and never read the whole dataset. WAL
+    # mode lets readers run alongside a writer, and SQLite's own locking
+    # (with a busy timeout) serializes writers from several processes.
+    #
+    # Connections come from a per-process pool; sqlite3 caches the compiled
+    # statements per connection, so the fixed SQL strings below are only
+    # prepared once per pooled connection.
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._pool = ConnectionPool(path, busy_timeout)
+        with self._pool.connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                ' id INTEGER PRIMARY KEY,'
+                ' username TEXT NOT NULL UNIQUE,'
+                ' password TEXT NOT NULL,'
+                ' role TEXT NOT NULL)'
+            )
+            # A change counter bumped by triggers, so other workers can
+            # cheaply tell whether anything changed.
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO meta (id, version) VALUES (1, 0)')
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                conn.execute(
+                    f'CREATE TRIGGER IF NOT EXISTS users_{event.lower()} AFTER {event} ON users'
+                    ' BEGIN UPDATE meta SET version = version + 1; END'
+                )
+
+    @staticmethod
+    def _row_to_user(row):
+        return {'username': row['username'], 'password': row['password'], 'role': row['role']}
+
+    def get_user(self, username):
+        with self._pool.connection() as conn:
+            row = conn.execute(
+                'SELECT username, password, role FROM users WHERE username = ?', (username,)
+            ).fetchone()
+        if row is None:
+            return None
+        user = self._row_to_user(row)
+        metrics.storage_bytes.inc(_row_bytes(user), direction='read')
+        return user
+
+    def add_user(self, user):
+        try:
+            with self._pool.connection() as conn:
+                conn.execute(
+                    'INSERT INTO users (username, password, role) VALUES (?, ?, ?)',
+                    (user['username'], user['password'], user['role']),
+                )
+        except sqlite3.IntegrityError:
+            return False
+        metrics.storage_bytes.inc(_row_bytes(user), direction='write')
+        return True
+
+    def add_many(self, users):
+        skipped = []
+        written = 0
+        with self._pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for user in users:
+                    cursor = conn.execute(
+                        'INSERT OR IGNORE INTO users (username, password, role) VALUES (?, ?, ?)',
+                        (user['username'], user['password'], user['role']),
+                    )
+                    if cursor.rowcount == 0:
+                        skipped.append(user['username'])
+                    else:
+                        written += _row_bytes(user)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        metrics.storage_bytes.inc(written, direction='write')
+        return skipped
+
+    def update_user(self, user):
+        with self._pool.connection() as conn:
+            cursor = conn.execute(
+                'UPDATE users SET password = ?, role = ? WHERE username = ?',
+                (user['password'], user['role'], user['username']),
+            )
+        if cursor.rowcount == 0:
+            return False
+        metrics.storage_bytes.inc(_row_bytes(user), direction='write')
+        return True
+
+    def delete_user(self, username):
+        with self._pool.connection() as conn:
+            cursor = conn.execute('DELETE FROM users WHERE username = ?', (username,))
+        return cursor.rowcount > 0
+
+    def delete_many(self, usernames):
+        with self._pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                deleted = 0
+                for username in set(usernames):
+                    deleted += conn.execute('DELETE FROM users WHERE username = ?',
+                                            (username,)).rowcount
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return deleted
+
+    def list_users(self):
+        with self._pool.connection() as conn:
+            rows = conn.execute('SELECT username, password, role FROM users ORDER BY id')
+            users = [self._row_to_user(row) for row in rows]
+        metrics.storage_bytes.inc(sum(map(_row_bytes, users)), direction='read')
+        return users
+
+    def generation(self):
+        with self._pool.connection() as conn:
+            return conn.execute('SELECT version FROM meta').fetchone()[0]
+
+    def __len__(self):
+        with self._pool.connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+
+class InstrumentedStore(UserStore):
+    # Wraps another store and records how long each operation takes.
+    def __init__(self, store, backend):
+        self.store = store
+        self.backend = backend
+
+    def _timed(self, op, *args):
+        with metrics.storage_seconds.time(backend=self.backend, op=op):
+            return getattr(self.store, op)(*args)
+
+    def get_user(self, username):
+        return self._timed('get_user', username)
+
+    def add_user(self, user):
+        return self._timed('add_user', user)
+
+    def add_many(self, users):
+        return self._timed('add_many', users)
+
+    def update_user(self, user):
+        return self._timed('update_user', user)
+
+    def delete_user(self, username):
+        return self._timed('delete_user', username)
+
+    def delete_many(self, usernames):
+        return self._timed('delete_many', usernames)
+
+    def list_users(self):
+        return self._timed('list_users')
+
+    def generation(self):
+        return self.store.generation()
+
+    def __len__(self):
+        return self._timed('__len__')
+
+
+def open_store(backend, path):
+    if backend == 'json':
+        return InstrumentedStore(JsonUserStore(path), backend)
+    if backend == 'journal':
+        return InstrumentedStore(JournalUserStore(path), backend)
+    if backend == 'sqlite':
+        return InstrumentedStore(SqliteUserStore(path), backend)
+    raise ValueError(f'unknown user storage backend: {backend!r}')
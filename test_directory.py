@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from directory import UserDirectory
+from storage import JsonUserStore, SqliteUserStore
+
+
+def user(name, role='student'):
+    return {'username': name, 'password': 'hash', 'role': role}
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def make_store(request, tmp_path):
+    def make():
+        if request.param == 'sqlite':
+            return SqliteUserStore(str(tmp_path / 'users.db'))
+        return JsonUserStore(str(tmp_path / 'users.json'))
+    return make
+
+
+class CountingDirectory(UserDirectory):
+    def __init__(self, store):
+        self.builds = 0
+        super().__init__(store, check_interval=0)
+
+    def _build(self):
+        self.builds += 1
+        return super()._build()
+
+
+def names(directory, **kwargs):
+    return [username for username, _ in directory.page(**kwargs)[0]]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_local_writes_do_not_rebuild(make_store):
+    store = make_store()
+    store.add_user(user('existing'))
+    directory = CountingDirectory(store)
+    assert names(directory) == ['existing']
+
+    for name in ('b', 'a', 'c'):
+        store.add_user(user(name))
+        directory.add(name, 'student')
+        names(directory)
+    store.add_many([user('e', 'admin'), user('d')])
+    directory.add_many([('e', 'admin'), ('d', 'student')])
+    store.delete_user('a')
+    directory.remove('a')
+    store.update_user(user('b', 'student'))
+    directory.sync_generation()
+
+    assert names(directory) == ['b', 'c', 'd', 'e', 'existing']
+    assert names(directory, role='admin') == ['e']
+    assert directory.builds == 1
+
+
+def test_writes_by_another_worker_trigger_a_rebuild(make_store):
+    store = make_store()
+    directory = CountingDirectory(store)
+    assert names(directory) == []
+
+    # A second store on the same file stands in for another worker.
+    make_store().add_user(user('elsewhere'))
+
+    wait_for(lambda: names(directory) == ['elsewhere'])
+    assert directory.builds == 2
+
+
+def test_pages_follow_the_cursor(make_store):
+    store = make_store()
+    store.add_many([user(f'u{i:02d}') for i in range(25)] + [user('x')])
+    directory = UserDirectory(store)
+
+    first, cursor = directory.page(prefix='u', limit=10)
+    second, cursor = directory.page(prefix='u', cursor=cursor, limit=10)
+    third, cursor = directory.page(prefix='u', cursor=cursor, limit=10)
+
+    assert [name for name, _ in first + second + third] == [f'u{i:02d}' for i in range(25)]
+    assert cursor is None
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+
+import pytest
+from flask import Flask, session
+
+import policy as policy_module
+from policy import PolicyEngine, PolicyError, compile_policy
+
+POLICY = {
+    'roles': {
+        'student': {'permissions': ['dashboard.view']},
+        'librarian': {'inherits': ['student'], 'permissions': ['books.edit']},
+        'admin': {'inherits': ['librarian'], 'permissions': ['users.list']},
+    }
+}
+
+
+def test_inherited_permissions():
+    policy = compile_policy(POLICY)
+
+    assert policy.allows('admin', 'dashboard.view')
+    assert policy.allows('admin', 'books.edit')
+    assert policy.allows('librarian', 'dashboard.view')
+    assert not policy.allows('librarian', 'users.list')
+    assert not policy.allows('student', 'books.edit')
+    assert not policy.allows('nobody', 'dashboard.view')
+    assert not policy.allows('admin', 'no.such.permission')
+
+
+def test_inheritance_cycle_is_rejected():
+    with pytest.raises(PolicyError, match='cycle'):
+        compile_policy({'roles': {'a': {'inherits': ['b']}, 'b': {'inherits': ['a']}}})
+
+
+def test_unknown_inherited_role_is_rejected():
+    with pytest.raises(PolicyError, match='unknown role'):
+        compile_policy({'roles': {'a': {'inherits': ['missing']}}})
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'roles': []},
+    {'roles': {'a': ['users.list']}},
+    {'roles': {'a': {'permissions': 'users.list'}}},
+    {'roles': {'a': {'inherits': [1]}}},
+])
+def test_malformed_policy_is_rejected(data):
+    with pytest.raises(PolicyError):
+        compile_policy(data)
+
+
+def write_policy(path, data, mtime_ns):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def policy_path(tmp_path):
+    path = str(tmp_path / 'policy.json')
+    write_policy(path, POLICY, 1_000_000_000)
+    return path
+
+
+def test_reload_picks_up_edits(policy_path):
+    engine = PolicyEngine(policy_path, reload_interval=0)
+    assert not engine.allows('student', 'books.edit')
+
+    write_policy(policy_path, {'roles': {'student': {'permissions': ['books.edit']}}}, 2_000_000_000)
+
+    assert engine.allows('student', 'books.edit')
+
+
+def test_bad_edit_keeps_previous_policy_and_is_parsed_once(policy_path, monkeypatch, caplog):
+    engine = PolicyEngine(policy_path, reload_interval=0)
+    loads = []
+    real_load = policy_module.load_policy
+    monkeypatch.setattr(policy_module, 'load_policy', lambda path: loads.append(path) or real_load(path))
+
+    write_policy(policy_path, {'roles': {'a': {'inherits': ['a']}}}, 2_000_000_000)
+    with caplog.at_level(logging.WARNING, logger='policy'):
+        for _ in range(3):
+            assert engine.allows('admin', 'users.list')
+
+    assert len(loads) == 1
+    assert len(caplog.records) == 1
+
+    write_policy(policy_path, {'roles': {'admin': {'permissions': []}}}, 3_000_000_000)
+
+    assert not engine.allows('admin', 'users.list')
+    assert len(loads) == 2
+
+
+@pytest.fixture
+def client(policy_path):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    engine = PolicyEngine(policy_path)
+
+    @app.route('/login')
+    def login():
+        return 'login page'
+
+    @app.route('/as/<username>/<role>')
+    def log_in_as(username, role):
+        session['username'] = username
+        session['role'] = role
+        return 'ok'
+
+    @app.route('/users')
+    @engine.requires('users.list')
+    def users():
+        return 'users'
+
+    return app.test_client()
+
+
+def test_requires_redirects_anonymous_users_to_login(client):
+    response = client.get('/users')
+
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/login')
+
+
+def test_requires_denies_roles_without_the_permission(client):
+    client.get('/as/sam/student')
+
+    assert client.get('/users').get_data(as_text=True) == 'Access Denied'
+
+
+def test_requires_allows_roles_with_the_permission(client):
+    client.get('/as/ada/admin')
+
+    assert client.get('/users').get_data(as_text=True) == 'users'
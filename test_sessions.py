@@ -0,0 +1,134 @@
+import time
+
+import pytest
+from flask import Flask, session
+
+import sessions
+from sessions import MemorySessionStore, ServerSessionInterface, SqliteSessionStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_store(request, tmp_path):
+    def make(**kwargs):
+        if request.param == 'sqlite':
+            return SqliteSessionStore(str(tmp_path / 'sessions.db'), **kwargs)
+        return MemorySessionStore(**kwargs)
+    return make
+
+
+def make_app(store):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.session_interface = ServerSessionInterface(store)
+
+    @app.route('/login/<username>')
+    def login(username):
+        session['username'] = username
+        return 'ok'
+
+    @app.route('/visit')
+    def visit():
+        session['visits'] = session.get('visits', 0) + 1
+        return 'ok'
+
+    @app.route('/whoami')
+    def whoami():
+        return session.get('username', '')
+
+    return app
+
+
+def whoami(client):
+    return client.get('/whoami').get_data(as_text=True)
+
+
+def session_id(client):
+    return client.get_cookie('session').value
+
+
+def test_revoke_user_ends_all_of_their_sessions(make_store):
+    store = make_store()
+    app = make_app(store)
+    alice1, alice2, bob = app.test_client(), app.test_client(), app.test_client()
+    alice1.get('/login/alice')
+    alice2.get('/login/alice')
+    bob.get('/login/bob')
+
+    store.revoke_user('alice')
+
+    assert whoami(alice1) == ''
+    assert whoami(alice2) == ''
+    assert whoami(bob) == 'bob'
+
+
+def test_login_rotates_the_session_id(make_store):
+    app = make_app(make_store())
+    client = app.test_client()
+    client.get('/visit')
+    anonymous_sid = session_id(client)
+
+    client.get('/login/alice')
+    alice_sid = session_id(client)
+    client.get('/login/bob')
+
+    assert len({anonymous_sid, alice_sid, session_id(client)}) == 3
+    assert whoami(client) == 'bob'
+    # The ids handed out before each login no longer work.
+    for old_sid in (anonymous_sid, alice_sid):
+        attacker = app.test_client()
+        attacker.set_cookie('session', old_sid)
+        assert whoami(attacker) == ''
+
+
+def test_unchanged_user_keeps_the_session_id(make_store):
+    app = make_app(make_store())
+    client = app.test_client()
+    client.get('/login/alice')
+    sid = session_id(client)
+
+    client.get('/visit')
+
+    assert session_id(client) == sid
+
+
+def test_sessions_expire_after_ttl(make_store, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    app = make_app(make_store(ttl=60))
+    client = app.test_client()
+    client.get('/login/alice')
+
+    now[0] += 59
+    assert whoami(client) == 'alice'
+    now[0] += 2
+    assert whoami(client) == ''
+
+
+def test_memory_store_evicts_least_recently_used():
+    app = make_app(MemorySessionStore(max_entries=2))
+    alice, bob, carol = app.test_client(), app.test_client(), app.test_client()
+    alice.get('/login/alice')
+    bob.get('/login/bob')
+    assert whoami(alice) == 'alice'
+
+    carol.get('/login/carol')
+
+    assert whoami(bob) == ''
+    assert whoami(alice) == 'alice'
+    assert whoami(carol) == 'carol'
+
+
+def test_sqlite_store_evicts_least_recently_saved(tmp_path, monkeypatch):
+    # Force the occasional trim on every save.
+    monkeypatch.setattr(sessions.random, 'randrange', lambda n: 0)
+    app = make_app(SqliteSessionStore(str(tmp_path / 'sessions.db'), max_entries=2))
+    alice, bob, carol = app.test_client(), app.test_client(), app.test_client()
+    alice.get('/login/alice')
+    bob.get('/login/bob')
+    assert whoami(alice) == 'alice'
+
+    carol.get('/login/carol')
+
+    assert whoami(alice) == ''
+    assert whoami(bob) == 'bob'
+    assert whoami(carol) == 'carol'
@@ -0,0 +1,215 @@
+import json
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import storage
+from storage import ConnectionPool, JournalUserStore, JsonUserStore, SqliteUserStore, UserStore
+
+
+def user(name, role='student'):
+    return {'username': name, 'password': 'hash', 'role': role}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'user_data.json')
+
+
+def test_replay_matches_writes(path):
+    store = JournalUserStore(path)
+    store.add_user(user('a'))
+    store.add_user(user('b', 'admin'))
+    store.delete_user('a')
+    store.add_user(user('c'))
+
+    assert JournalUserStore(path).list_users() == [user('b', 'admin'), user('c')]
+
+
+def test_replay_ignores_torn_tail(path):
+    JournalUserStore(path).add_user(user('a'))
+    with open(path + '.journal', 'ab') as f:
+        f.write(b'{"op": "add", "user": {"username": "b"')
+
+    assert JournalUserStore(path).list_users() == [user('a')]
+
+
+def test_next_writer_truncates_torn_tail(path):
+    JournalUserStore(path).add_user(user('a'))
+    with open(path + '.journal', 'ab') as f:
+        f.write(b'{"op": "add", "us')
+
+    JournalUserStore(path).add_user(user('b'))
+
+    with open(path + '.journal', 'rb') as f:
+        lines = f.read().splitlines()
+    assert [json.loads(line)['user']['username'] for line in lines] == ['a', 'b']
+    assert JournalUserStore(path).list_users() == [user('a'), user('b')]
+
+
+def test_compact_writes_snapshot_and_empties_journal(path):
+    store = JournalUserStore(path)
+    store.add_user(user('a'))
+    store.add_user(user('b'))
+    store.delete_user('a')
+    store.compact()
+
+    with open(path) as f:
+        assert json.load(f) == [user('b')]
+    assert os.path.getsize(path + '.journal') == 0
+    assert JournalUserStore(path).list_users() == [user('b')]
+
+
+def test_crash_between_compaction_renames_replays_idempotently(path, monkeypatch):
+    store = JournalUserStore(path)
+    store.add_user(user('a'))
+    store.add_user(user('b'))
+    store.delete_user('a')
+    store.add_user(user('a', 'admin'))
+
+    # Let the snapshot rename through, then "crash" before the journal is
+    # replaced, leaving the new snapshot next to the full old journal.
+    real_replace = os.replace
+    calls = []
+
+    def crashing_replace(src, dst):
+        calls.append(dst)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        real_replace(src, dst)
+
+    monkeypatch.setattr(storage.os, 'replace', crashing_replace)
+    with pytest.raises(KeyboardInterrupt):
+        store.compact()
+    monkeypatch.undo()
+
+    assert calls == [path, path + '.journal']
+    assert os.path.getsize(path + '.journal') > 0
+    assert JournalUserStore(path).list_users() == [user('b'), user('a', 'admin')]
+
+
+def test_compact_syncs_directory_after_each_rename(path, monkeypatch):
+    store = JournalUserStore(path)
+    store.add_user(user('a'))
+
+    events = []
+    real_replace = os.replace
+
+    def recording_replace(src, dst):
+        events.append(('replace', dst))
+        real_replace(src, dst)
+
+    monkeypatch.setattr(storage.os, 'replace', recording_replace)
+    monkeypatch.setattr(storage, '_fsync_dir', lambda p: events.append(('fsync_dir', p)))
+    store.compact()
+
+    assert events == [('replace', path), ('fsync_dir', path),
+                      ('replace', path + '.journal'), ('fsync_dir', path + '.journal')]
+
+
+def _add_users(store, worker, count):
+    for i in range(count):
+        assert store.add_user(user(f'w{worker}u{i}'))
+
+
+def test_forked_workers_share_one_store(path):
+    # The store is created before forking, as with a preloading server, so the
+    # workers inherit its open files.
+    store = JournalUserStore(path, compact_bytes=4096)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_add_users, args=(store, w, 100)) for w in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert [worker.exitcode for worker in workers] == [0] * 4
+    users = JournalUserStore(path).list_users()
+    assert len(users) == 400
+    assert {u['username'] for u in users} == {f'w{w}u{i}' for w in range(4) for i in range(100)}
+
+
+def _write_users(path, worker, count):
+    store = JsonUserStore(path)
+    for i in range(count):
+        store.add_user(user(f'w{worker}u{i}'))
+
+
+def test_json_readers_never_see_a_partial_file(path):
+    JsonUserStore(path)
+    context = multiprocessing.get_context('fork')
+    writers = [context.Process(target=_write_users, args=(path, w, 200)) for w in range(2)]
+    for writer in writers:
+        writer.start()
+    reader = JsonUserStore(path)
+    while any(writer.is_alive() for writer in writers):
+        reader.list_users()
+    for writer in writers:
+        writer.join()
+
+    assert [writer.exitcode for writer in writers] == [0, 0]
+    assert JsonUserStore(path).list_users()
+
+
+def test_json_crash_during_write_keeps_old_file(path, monkeypatch):
+    store = JsonUserStore(path)
+    store.add_user(user('a'))
+
+    def crashing_dump(obj, f, **kwargs):
+        f.write('[{"username": ')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(storage.json, 'dump', crashing_dump)
+    with pytest.raises(KeyboardInterrupt):
+        store.add_user(user('b'))
+    monkeypatch.undo()
+
+    assert JsonUserStore(path).list_users() == [user('a')]
+
+
+def test_store_missing_a_method_fails_on_construction():
+    class Incomplete(UserStore):
+        def get_user(self, username):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_sqlite_connections_are_reused_across_threads(tmp_path):
+    store = SqliteUserStore(str(tmp_path / 'users.db'))
+    opened = []
+    real_open = store._pool._open
+    store._pool._open = lambda: opened.append(1) or real_open()
+
+    # A new thread per request, as with a threaded server.
+    for i in range(20):
+        thread = threading.Thread(target=store.add_user, args=(user(f'u{i}'),))
+        thread.start()
+        thread.join()
+
+    assert len(store.list_users()) == 20
+    assert len(opened) <= 1
+
+
+def _check_pool_in_child(pool, parent_conn, result):
+    with pool.connection() as conn:
+        result.put(conn is not parent_conn and conn.execute('SELECT 1').fetchone()[0] == 1)
+
+
+def test_connection_pool_is_not_shared_across_fork(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'))
+    with pool.connection() as conn:
+        parent_conn = conn
+    context = multiprocessing.get_context('fork')
+    result = context.Queue()
+    child = context.Process(target=_check_pool_in_child, args=(pool, parent_conn, result))
+    child.start()
+    child.join()
+
+    assert child.exitcode == 0
+    assert result.get(timeout=5)
+    with pool.connection() as conn:
+        assert conn is parent_conn